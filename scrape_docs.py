@@ -1,78 +1,192 @@
 import os
 import re
 import time
+import hashlib
+import sqlite3
 import logging
+import threading
+import multiprocessing
+from collections import deque
+from contextlib import closing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from urllib.parse import urljoin, urlparse
 
-import requests
-from bs4 import BeautifulSoup
+import httpx
+import lxml.html
+from lxml import etree
 from readability import Document
+from readability.htmls import shorten_title
 import html2text
 
 BASE_URL = "https://faq-ru.kaiten.site"
+BASE_NETLOC = urlparse(BASE_URL).netloc
 OUTPUT_DIR = "out"
+STATE_FILE = "crawl_state.sqlite"  # что уже скачано — чтобы повторный запуск не делал работу заново
+# поднимай при любом изменении разбора статей: страницы, разобранные старой версией, разберутся заново
+EXTRACTOR_VERSION = 1
 
 # --- настройки ---
 
-DELAY_BETWEEN_REQUESTS = 0.2  # секунды, чтобы не долбить сайт
-SESSION = requests.Session()
-SESSION.headers.update({
-    "User-Agent": "KaitenFAQExporter/1.0 (+https://kaiten.ru)"
-})
+# расширения, которые пропускаем (добавь свои при необходимости);
+# кортеж, чтобы str.endswith проверял все разом
+BINARY_EXTENSIONS = (
+    ".png", ".jpg", ".jpeg", ".gif", ".svg",
+    ".webp", ".ico", ".mp4", ".mov", ".avi",
+    ".pdf", ".zip", ".rar", ".7z",
+)
+
+DELAY_BETWEEN_REQUESTS = 0.2  # секунды между запросами (суммарно по всем потокам)
+MAX_WORKERS = 8  # сколько страниц качаем параллельно
+# процессы для разбора HTML: страница разбирается ~100-150 мс, а LIMITER пускает
+# не больше запроса в DELAY_BETWEEN_REQUESTS, так что больше двух всё равно простаивают
+PARSE_WORKERS = min(2, os.cpu_count() or 1)
+MAX_PAGE_BYTES = 2_000_000  # страницы больше этого явно не статьи, не качаем
+
+# один клиент на все потоки: HTTP/2 мультиплексирует запросы в одном соединении
+# (если сервер не умеет HTTP/2, httpx сам откатится на HTTP/1.1 с keep-alive)
+CLIENT = httpx.Client(
+    http2=True,
+    headers={"User-Agent": "KaitenFAQExporter/1.0 (+https://kaiten.ru)"},
+    limits=httpx.Limits(max_connections=MAX_WORKERS, max_keepalive_connections=MAX_WORKERS),
+    follow_redirects=True,
+    timeout=15,
+)
+
+SLUG_CHARS_RE = re.compile(r"[^0-9A-Za-zА-Яа-я]+")
+
+# lxml не принимает str с <?xml ... encoding=...?> — html у нас уже раскодирован, декларацию убираем
+XML_DECL_RE = re.compile(r"^\ufeff?\s*<\?xml[^>]*\?>", re.IGNORECASE)
+
+# теги, которые html2text всё равно выбросит (картинки мы игнорируем) —
+# вырезаем их из lxml-дерева заранее, чтобы не сериализовать и не разбирать повторно
+NON_TEXT_TAGS = ("script", "style", "noscript", "template", "svg", "img", "picture", "video", "iframe")
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s"
 )
+# httpx пишет каждый запрос в INFO, а мы и так логируем GET сами
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # --- вспомогательные функции ---
 
 def is_same_domain(url: str) -> bool:
     """Проверяем, что ссылка внутри faq-ru.kaiten.site."""
     try:
-        return urlparse(url).netloc == urlparse(BASE_URL).netloc
+        return urlparse(url).netloc == BASE_NETLOC
     except Exception:
         return False
 
 
 def looks_like_binary(url: str) -> bool:
     """Отфильтровываем картинки, видео и т.п."""
-    parsed = urlparse(url)
-    path = parsed.path.lower()
-    # расширения, которые пропускаем (добавь свои при необходимости)
-    bad_ext = [
-        ".png", ".jpg", ".jpeg", ".gif", ".svg",
-        ".webp", ".ico", ".mp4", ".mov", ".avi",
-        ".pdf", ".zip", ".rar", ".7z"
-    ]
-    return any(path.endswith(ext) for ext in bad_ext)
+    return urlparse(url).path.lower().endswith(BINARY_EXTENSIONS)
 
 
 def make_slug(text: str) -> str:
     """Человекопонятный слаг из заголовка."""
-    text = text.strip()
-    # заменяем всё кроме букв/цифр на дефисы
-    text = re.sub(r"[^0-9A-Za-zА-Яа-я]+", "-", text)
-    text = re.sub(r"-{2,}", "-", text)
-    return text.strip("-") or "page"
+    # заменяем всё кроме букв/цифр на дефисы; «+» в шаблоне сразу схлопывает серии в один дефис
+    return SLUG_CHARS_RE.sub("-", text.strip()).strip("-") or "page"
+
+
+class RateLimiter:
+    """Не больше одного запроса за interval секунд, сколько бы потоков ни качали."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_ok = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Бронирует слот и возвращает, сколько секунд подождать до запроса."""
+        with self.lock:
+            now = time.monotonic()
+            wait_for = self.next_ok - now
+            self.next_ok = max(now, self.next_ok) + self.interval
+        return max(0.0, wait_for)
+
 
+# обходим только BASE_NETLOC, так что один лимитер и есть лимитер на хост
+LIMITER = RateLimiter(DELAY_BETWEEN_REQUESTS)
 
-def fetch(url: str) -> str:
+
+def fetch(url: str, headers: dict | None = None) -> tuple[str | None, httpx.Headers]:
+    """
+    Качаем страницу (headers — условные заголовки If-None-Match/If-Modified-Since).
+    Возвращает (html, заголовки ответа); html=None, если сервер ответил 304.
+    """
+    time.sleep(LIMITER.acquire())
     logging.info(f"GET {url}")
-    resp = SESSION.get(url, timeout=15)
-    resp.raise_for_status()
-    return resp.text
+    with CLIENT.stream("GET", url, headers=headers) as resp:
+        if resp.status_code == 304:
+            return None, resp.headers
+        resp.raise_for_status()
+
+        # бинарники, которые проскочили looks_like_binary, отсекаем по заголовкам;
+        # страницу без Content-Type пропускаем, как и раньше
+        content_type = resp.headers.get("Content-Type")
+        if content_type and "html" not in content_type.lower():
+            raise ValueError(f"not an HTML page: {content_type}")
+        if int(resp.headers.get("Content-Length") or 0) > MAX_PAGE_BYTES:
+            raise ValueError("page is too large")
+
+        chunks = []
+        size = 0
+        for chunk in resp.iter_bytes():
+            size += len(chunk)
+            if size > MAX_PAGE_BYTES:
+                raise ValueError("page is too large")
+            chunks.append(chunk)
+
+    # кодировку берём из заголовка, без угадывания по содержимому
+    html = b"".join(chunks).decode(resp.charset_encoding or "utf-8", errors="replace")
+    return html, resp.headers
+
+
+def extract_links(tree: lxml.html.HtmlElement) -> list[str]:
+    """Ссылки <a href> со страницы, которые стоит обходить дальше."""
+    links = []
+    for el, attr, href, _pos in tree.iterlinks():
+        if el.tag != "a" or attr != "href":
+            continue
+        # нормализуем относительные ссылки
+        abs_url = urljoin(BASE_URL, href.strip())
+
+        if not is_same_domain(abs_url):
+            continue
+        if looks_like_binary(abs_url):
+            continue
+        links.append(abs_url)
+    return links
 
 
-def extract_article_text(html: str) -> tuple[str, str]:
+def extract_article_text(tree: lxml.html.HtmlElement, html: str) -> tuple[str, str]:
     """
-    Используем Readability для выделения основного контента,
-    затем html2text для конвертации в markdown/текст.
+    Берём из уже разобранной lxml-страницы единственный <article>, а если его нет —
+    <main>; Readability зовём, когда нет ни того ни другого или <article> несколько
+    (списки статей).
+    Затем html2text конвертирует фрагмент в markdown/текст.
+    Дерево при этом меняется (вырезаются NON_TEXT_TAGS).
     Возвращает (title, body_md).
     """
-    doc = Document(html)
-    title = doc.short_title() or "Без названия"
-    article_html = doc.summary(html_partial=True)
+    title = shorten_title(tree) or "Без названия"
+
+    # <main> часто оборачивает ещё и сайдбар, поэтому <article> в приоритете
+    articles = tree.xpath("//article")
+    if len(articles) == 1:
+        container = articles[0]
+    elif not articles:
+        mains = tree.xpath("//main")
+        container = mains[0] if mains else None
+    else:
+        container = None
+
+    if container is not None:
+        etree.strip_elements(container, *NON_TEXT_TAGS, with_tail=False)
+        article_html = lxml.html.tostring(container, encoding="unicode", with_tail=False)
+    else:
+        article_html = Document(html).summary(html_partial=True)
 
     h = html2text.HTML2Text()
     h.ignore_images = True
@@ -84,74 +198,196 @@ def extract_article_text(html: str) -> tuple[str, str]:
     return title, body_md
 
 
-def save_article(title: str, body_md: str):
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
+def save_article(title: str, body_md: str) -> str:
+    # OUTPUT_DIR создаётся один раз в crawl(), а не на каждую статью
     slug = make_slug(title)
     filename = os.path.join(OUTPUT_DIR, f"{slug}.md")
     logging.info(f"Saving article: {filename}")
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(f"# {title}\n\n{body_md}")
+    Path(filename).write_text(f"# {title}\n\n{body_md}", encoding="utf-8")
+    return filename
+
+
+# --- состояние обхода между запусками ---
+
+def open_state(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pages (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            sha1 TEXT,
+            filename TEXT,  -- куда сохранили статью (NULL, если статьи на странице нет)
+            links TEXT,     -- ссылки со страницы построчно, чтобы обход шёл дальше без разбора
+            extractor INTEGER  -- EXTRACTOR_VERSION, которой разобрана страница
+        )
+        """
+    )
+    return conn
+
+
+def load_page_state(conn: sqlite3.Connection, url: str) -> sqlite3.Row | None:
+    """
+    Что знаем о странице с прошлых запусков; None, если её сохранённую статью удалили
+    или страницу разбирала другая версия экстрактора.
+    """
+    row = conn.execute("SELECT * FROM pages WHERE url = ?", (url,)).fetchone()
+    if row is None or row["extractor"] != EXTRACTOR_VERSION:
+        return None
+    if row["filename"] and not os.path.exists(row["filename"]):
+        return None
+    return row
+
+
+def save_page_state(conn: sqlite3.Connection, url: str, headers: httpx.Headers,
+                    sha1: str, filename: str | None, links: list[str]):
+    # коммитим сразу: прерванный по Ctrl-C обход ничего не теряет
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO pages (url, etag, last_modified, sha1, filename, links, extractor)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (url, headers.get("ETag"), headers.get("Last-Modified"), sha1, filename,
+             "\n".join(links), EXTRACTOR_VERSION),
+        )
+
+
+def stored_links(state: sqlite3.Row | None) -> list[str]:
+    if state is None or not state["links"]:
+        return []
+    return state["links"].split("\n")
+
+
+def conditional_headers(state: sqlite3.Row | None) -> dict:
+    """If-None-Match/If-Modified-Since по сохранённому состоянию страницы."""
+    headers = {}
+    if state is not None:
+        if state["etag"]:
+            headers["If-None-Match"] = state["etag"]
+        if state["last_modified"]:
+            headers["If-Modified-Since"] = state["last_modified"]
+    return headers
 
 
 # --- основной обход ---
 
-def crawl():
-    to_visit = [BASE_URL]
-    visited = set()
-
-    while to_visit:
-        url = to_visit.pop(0)
-
-        # убираем якоря/дубликаты
-        url = url.split("#", 1)[0]
+def process_page(url: str, html: str) -> tuple[str | None, list[str], bool]:
+    """
+    Сохраняем статью со страницы.
+    Возвращает (файл статьи или None, найденные на странице ссылки для обхода,
+    ok — False, если разбор или сохранение упали и страницу надо повторить в следующий раз).
+    """
+    filename = None
+    ok = True
 
-        if url in visited:
-            continue
-        visited.add(url)
+    # разбираем HTML один раз и для ссылок, и для статьи
+    html = XML_DECL_RE.sub("", html, count=1)
+    try:
+        tree = lxml.html.fromstring(html)
+    except Exception as e:
+        logging.warning(f"Failed to parse HTML {url}: {e}")
+        return filename, [], False
 
-        # фильтр на бинарные ресурсы
-        if looks_like_binary(url):
-            continue
+    # ссылки собираем первыми: extract_article_text вырезает часть дерева
+    links = extract_links(tree)
 
+    # если это не главная, считаем, что это «страница с контентом» и вытаскиваем текст
+    if url != BASE_URL:
         try:
-            html = fetch(url)
+            title, body_md = extract_article_text(tree, html)
+
+            # маленький фильтр на «шум»: если текста совсем мало, можно пропустить
+            if len(body_md.strip()) > 20:  # порог символов, подстрой под себя
+                filename = save_article(title, body_md)
+            else:
+                logging.info(f"Skip {url}: too short content")
         except Exception as e:
-            logging.warning(f"Failed to fetch {url}: {e}")
-            continue
+            logging.warning(f"Failed to parse article {url}: {e}")
+            ok = False
 
-        # если это не главная, считаем, что это «страница с контентом» и вытаскиваем текст
-        if url != BASE_URL:
-            try:
-                title, body_md = extract_article_text(html)
+    return filename, links, ok
 
-                # маленький фильтр на «шум»: если текста совсем мало, можно пропустить
-                if len(body_md.strip()) > 20:  # порог символов, подстрой под себя
-                    save_article(title, body_md)
-                else:
-                    logging.info(f"Skip {url}: too short content")
-            except Exception as e:
-                logging.warning(f"Failed to parse article {url}: {e}")
 
-        # Парсим ссылки для дальнейшего обхода
-        try:
-            soup = BeautifulSoup(html, "html.parser")
-        except Exception as e:
-            logging.warning(f"Failed to parse HTML for links {url}: {e}")
-            continue
+def crawl():
+    to_visit = deque([BASE_URL])
+    queued = {BASE_URL}  # то же, что в to_visit, но с проверкой за O(1)
+    visited = set()
+    fetching = {}  # future -> (url, состояние страницы с прошлого запуска)
+    parsing = {}  # future -> (url, заголовки ответа, sha1 страницы)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-        for a in soup.find_all("a", href=True):
-            href = a["href"].strip()
-            # нормализуем относительные ссылки
-            abs_url = urljoin(BASE_URL, href)
+    def enqueue(links: list[str]):
+        for abs_url in links:
+            # убираем якоря сразу, чтобы /page#a и /page#b занимали одно место в очереди и множествах
+            abs_url = abs_url.split("#", 1)[0]
+            if abs_url not in visited and abs_url not in queued:
+                queued.add(abs_url)
+                to_visit.append(abs_url)
 
-            if not is_same_domain(abs_url):
+    # в потоках качаем, в процессах разбираем HTML (readability/html2text держат GIL);
+    # очередь и state_db живут только в основном потоке, поэтому блокировки не нужны
+    with closing(open_state(STATE_FILE)) as state_db, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as fetch_pool, \
+            ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS,
+                # spawn, а не fork: к этому моменту уже работают потоки загрузки, открыты
+                # HTTP/2-соединение и state_db — копировать их в дочерние процессы нельзя
+                mp_context=multiprocessing.get_context("spawn"),
+            ) as parse_pool:
+        while to_visit or fetching or parsing:
+            while to_visit and len(fetching) < MAX_WORKERS:
+                url = to_visit.popleft()
+                queued.discard(url)
+                visited.add(url)
+
+                # фильтр на бинарные ресурсы
+                if looks_like_binary(url):
+                    continue
+
+                state = load_page_state(state_db, url)
+                future = fetch_pool.submit(fetch, url, conditional_headers(state))
+                fetching[future] = (url, state)
+
+            if not fetching and not parsing:
                 continue
-            if looks_like_binary(abs_url):
-                continue
-            if abs_url not in visited and abs_url not in to_visit:
-                to_visit.append(abs_url)
 
-        time.sleep(DELAY_BETWEEN_REQUESTS)
+            done, _ = wait([*fetching, *parsing], return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in parsing:
+                    url, headers, sha1 = parsing.pop(future)
+                    try:
+                        filename, links, ok = future.result()
+                    except Exception as e:
+                        logging.warning(f"Failed to process {url}: {e}")
+                        continue
+                    # неудачный разбор не запоминаем: иначе следующий запуск получит 304
+                    # или тот же sha1 и никогда не повторит страницу
+                    if ok:
+                        save_page_state(state_db, url, headers, sha1, filename, links)
+                    enqueue(links)
+                    continue
+
+                url, state = fetching.pop(future)
+                try:
+                    html, headers = future.result()
+                except Exception as e:
+                    logging.warning(f"Failed to fetch {url}: {e}")
+                    continue
+
+                if html is None:
+                    logging.info(f"Not modified: {url}")
+                    enqueue(stored_links(state))
+                    continue
+
+                sha1 = hashlib.sha1(html.encode("utf-8")).hexdigest()
+                if state is not None and state["sha1"] == sha1:
+                    logging.info(f"Unchanged: {url}")
+                    save_page_state(state_db, url, headers, sha1, state["filename"], stored_links(state))
+                    enqueue(stored_links(state))
+                    continue
+
+                parsing[parse_pool.submit(process_page, url, html)] = (url, headers, sha1)
 
     logging.info(f"Done. Visited {len(visited)} pages.")
 